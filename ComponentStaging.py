@@ -0,0 +1,265 @@
+"""
+Content addressed staging of the custom components and data files in a McStas input folder
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+
+class ComponentStage:
+    """
+    Store for the files in McStas input folders, addressed by their content
+
+    Each file is hashed once and kept as a single read-only object in the
+    stage folder. Runs get their own view folder where the files are
+    hardlinks to these objects, so simultaneous runs share one copy on disk
+    and in the page cache. The index of hashed files is kept on disk, and
+    only files with a changed size or modification time are hashed again.
+    Objects no longer referenced by the index are removed from the store.
+    """
+
+    def __init__(self, stage_path):
+        """
+        :param stage_path: Folder holding the object store, index and views
+        :type stage_path: str
+        """
+        if not isinstance(stage_path, str):
+            raise ValueError("stage_path must be a string.")
+
+        self.stage_path = os.path.abspath(stage_path)
+        self.objects_path = os.path.join(self.stage_path, "objects")
+        self.views_path = os.path.join(self.stage_path, "views")
+        self.index_file = os.path.join(self.stage_path, "index.json")
+        self.lock_file = os.path.join(self.stage_path, "lock")
+
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.views_path, exist_ok=True)
+
+        self.index = self._read_index()
+        self._lock_depth = 0
+
+    def stage(self, input_path, exclude=(), generated=()):
+        """
+        Stages the files in input_path in a new view folder
+
+        The view is meant for a single run, which writes its instrument and
+        compiled files next to the hardlinks, and should be removed with
+        release when the run is done.
+
+        :param input_path: Folder with custom components and data files
+        :type input_path: str
+
+        :param exclude: Folders not staged, see update
+        :type exclude: list of str
+
+        :param generated: Names of files written by the run, never staged
+        :type generated: list of str
+
+        :return: Path of the view folder containing hardlinks to the objects
+        """
+        with self._locked():
+            manifest = self.update(input_path, exclude, generated)
+
+            # Linked while holding the lock, so no object is collected meanwhile
+            view_path = tempfile.mkdtemp(prefix="view_", dir=self.views_path)
+            for relative_path, digest in manifest.items():
+                target = os.path.join(view_path, relative_path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                self._link(self._object_path(digest), target)
+
+        return view_path
+
+    def release(self, view_path):
+        """ Removes a view folder made by stage, the objects are kept """
+        view_path = os.path.abspath(view_path)
+        if os.path.dirname(view_path) != self.views_path:
+            raise ValueError("Not a view of this stage: " + view_path)
+        shutil.rmtree(view_path, ignore_errors=True)
+
+    def update(self, input_path, exclude=(), generated=()):
+        """
+        Adds new and changed files in input_path to the store
+
+        The stage folder, McStas result folders and the folders in exclude
+        are skipped. An excluded folder also covers folders named like it
+        followed by _, such as the output_path_0 folders of
+        increment_folder_name and the temporary folders of append mode.
+        Index entries of files removed from input_path are dropped, and
+        objects no entry refers to are removed from the store.
+
+        :param input_path: Folder with custom components and data files
+        :type input_path: str
+
+        :param exclude: Folders not staged
+        :type exclude: list of str
+
+        :param generated: Names of files written by the run, never staged
+        :type generated: list of str
+
+        :return: dict from path relative to input_path to content digest
+        """
+        input_path = os.path.abspath(input_path)
+        if not os.path.isdir(input_path):
+            raise ValueError("input_path must be an existing folder, got: " + input_path)
+
+        excluded = [self.stage_path] + [os.path.abspath(path) for path in exclude]
+        generated = set(generated)
+
+        with self._locked():
+            # Pick up entries written by other processes using the stage
+            self.index = self._read_index()
+
+            manifest = {}
+            seen = set()
+            index_changed = False
+            for root, dirs, files in os.walk(input_path):
+                dirs[:] = sorted(folder for folder in dirs
+                                 if not _is_excluded(os.path.join(root, folder), excluded)
+                                 and not os.path.isfile(os.path.join(root, folder, "mccode.sim")))
+                for file_name in sorted(files):
+                    if file_name in generated:
+                        continue
+                    source = os.path.join(root, file_name)
+                    relative_path = os.path.relpath(source, input_path)
+                    status = os.stat(source)
+                    seen.add(source)
+
+                    entry = self.index.get(source)
+                    if (entry is None
+                            or entry["size"] != status.st_size
+                            or entry["mtime_ns"] != status.st_mtime_ns
+                            or not os.path.exists(self._object_path(entry["digest"]))):
+                        digest = self._store(source)
+                        self.index[source] = {"size": status.st_size,
+                                              "mtime_ns": status.st_mtime_ns,
+                                              "digest": digest}
+                        index_changed = True
+
+                    manifest[relative_path] = self.index[source]["digest"]
+
+            for source in list(self.index):
+                if source.startswith(input_path + os.sep) and source not in seen:
+                    del self.index[source]
+                    index_changed = True
+
+            if index_changed:
+                self._write_index()
+                self.collect()
+
+        return manifest
+
+    def collect(self):
+        """
+        Removes objects not referenced by the index
+
+        Views keep their own hardlinks, so runs using an object are not
+        affected when it is removed from the store.
+        """
+        with self._locked():
+            referenced = {entry["digest"] for entry in self._read_index().values()}
+            for prefix in os.listdir(self.objects_path):
+                prefix_path = os.path.join(self.objects_path, prefix)
+                for name in os.listdir(prefix_path):
+                    if prefix + name not in referenced:
+                        os.remove(os.path.join(prefix_path, name))
+                if len(os.listdir(prefix_path)) == 0:
+                    os.rmdir(prefix_path)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Holds an exclusive lock on the stage folder, reentrant within this object
+
+        The index and the objects are shared by all processes using the
+        stage folder, so they are only changed while holding the lock.
+        """
+        if self._lock_depth > 0:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+
+        with open(self.lock_file, "a") as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            self._lock_depth = 1
+            try:
+                yield
+            finally:
+                self._lock_depth = 0
+                fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+    def _store(self, source):
+        """
+        Hashes source and copies it into the store unless already present
+        """
+        digest = _hash_file(source)
+        object_path = self._object_path(digest)
+        if os.path.exists(object_path):
+            return digest
+
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(object_path))
+        os.close(handle)
+        try:
+            shutil.copyfile(source, temporary_path)
+            os.chmod(temporary_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            # Atomic, so concurrent stagers never see a partial object
+            os.replace(temporary_path, object_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        return digest
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest[2:])
+
+    def _link(self, object_path, target):
+        """
+        Hardlinks object to target, copies if the view is on another device
+        """
+        try:
+            os.link(object_path, target)
+        except OSError:
+            shutil.copyfile(object_path, target)
+
+    def _read_index(self):
+        if not os.path.isfile(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, "r") as file_handle:
+                return json.load(file_handle)
+        except (OSError, ValueError):
+            # A broken index only costs rehashing the files
+            return {}
+
+    def _write_index(self):
+        handle, temporary_path = tempfile.mkstemp(dir=self.stage_path)
+        with os.fdopen(handle, "w") as file_handle:
+            json.dump(self.index, file_handle)
+        os.replace(temporary_path, self.index_file)
+
+
+def _is_excluded(folder, excluded):
+    """ True if folder is one of excluded, or named like one followed by _ """
+    return any(folder == path or folder.startswith(path + "_") for path in excluded)
+
+
+def _hash_file(path, block_size=1 << 20):
+    """
+    Returns sha256 hex digest of the file at path
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as file_handle:
+        for block in iter(lambda: file_handle.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
@@ -0,0 +1,279 @@
+"""
+Streaming histogramming of event mode monitor output with bounded memory
+"""
+
+import io
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class Histogram:
+    """
+    Weighted 1D or 2D histogram of columns in an event file
+
+    Keeps the sum of weights, the sum of squared weights and the number of
+    events in each bin, so intensity and error can be reported as McStas
+    does for its own monitors.
+    """
+
+    def __init__(self, name, columns, bins, ranges, weight_column=None):
+        """
+        :param name: Name used to look up the histogram after reduction
+        :type name: str
+
+        :param columns: Index of event column per axis, one or two axes
+        :type columns: int or tuple of int
+
+        :param bins: Number of bins per axis
+        :type bins: int or tuple of int
+
+        :param ranges: (min, max) limits per axis
+        :type ranges: tuple or tuple of tuple
+
+        :param weight_column: Index of column with ray weight, unweighted if None
+        :type weight_column: int
+        """
+        if not isinstance(name, str):
+            raise ValueError("Histogram name must be a string.")
+        self.name = name
+
+        if isinstance(columns, int):
+            columns = (columns,)
+            bins = (bins,)
+            ranges = (ranges,)
+
+        self.columns = tuple(columns)
+        self.bins = tuple(bins)
+        self.ranges = tuple(tuple(limits) for limits in ranges)
+
+        if len(self.columns) not in (1, 2):
+            raise ValueError("Histogram must have one or two axes.")
+        if len(self.bins) != len(self.columns) or len(self.ranges) != len(self.columns):
+            raise ValueError("bins and ranges must be given for each column.")
+        for n_bins in self.bins:
+            if not isinstance(n_bins, int) or n_bins <= 0:
+                raise ValueError("Number of bins must be a positive integer.")
+        for low, high in self.ranges:
+            if not high > low:
+                raise ValueError("Histogram range must have max larger than min.")
+
+        if weight_column is not None and not isinstance(weight_column, int):
+            raise ValueError("weight_column must be an integer.")
+        self.weight_column = weight_column
+
+        self.intensity = np.zeros(self.bins)
+        self.sum_weights_squared = np.zeros(self.bins)
+        self.events = np.zeros(self.bins, dtype=np.int64)
+
+    @property
+    def error(self):
+        """ Error on intensity from the sum of squared weights """
+        return np.sqrt(self.sum_weights_squared)
+
+    @property
+    def edges(self):
+        """ Bin edges for each axis """
+        return [np.linspace(low, high, n_bins + 1)
+                for n_bins, (low, high) in zip(self.bins, self.ranges)]
+
+    def empty_copy(self):
+        """ Returns histogram with same binning and no accumulated events """
+        if len(self.columns) == 1:
+            return Histogram(self.name, self.columns[0], self.bins[0],
+                             self.ranges[0], self.weight_column)
+        return Histogram(self.name, self.columns, self.bins,
+                         self.ranges, self.weight_column)
+
+    def accumulate(self, events):
+        """
+        Adds a block of events to the histogram
+
+        :param events: Array with one row per event and one column per variable
+        :type events: numpy.ndarray
+        """
+        n_events = events.shape[0]
+        if n_events == 0:
+            return
+
+        inside = np.ones(n_events, dtype=bool)
+        flat_index = np.zeros(n_events, dtype=np.int64)
+        for column, n_bins, (low, high) in zip(self.columns, self.bins, self.ranges):
+            values = np.asarray(events[:, column], dtype=np.float64)
+            index = np.floor((values - low) * (n_bins / (high - low))).astype(np.int64)
+            # Right edge belongs to the last bin as in numpy.histogram
+            index[values == high] = n_bins - 1
+            inside &= (index >= 0) & (index < n_bins)
+            flat_index = flat_index * n_bins + index
+
+        flat_index = flat_index[inside]
+        if self.weight_column is None:
+            weights = np.ones(flat_index.shape[0])
+        else:
+            weights = np.asarray(events[:, self.weight_column], dtype=np.float64)[inside]
+
+        size = int(np.prod(self.bins))
+        self.intensity += np.bincount(flat_index, weights=weights,
+                                      minlength=size).reshape(self.bins)
+        self.sum_weights_squared += np.bincount(flat_index, weights=weights*weights,
+                                                minlength=size).reshape(self.bins)
+        self.events += np.bincount(flat_index, minlength=size).reshape(self.bins)
+
+    def merge(self, other):
+        """ Adds the sums of another histogram with the same binning """
+        if (other.columns != self.columns or other.bins != self.bins
+                or other.ranges != self.ranges):
+            raise ValueError("Can only merge histograms with the same binning.")
+        self.intensity += other.intensity
+        self.sum_weights_squared += other.sum_weights_squared
+        self.events += other.events
+
+
+class EventReducer:
+    """
+    Reads an event file in fixed size chunks and fills a set of histograms
+
+    Binary files are memory mapped as rows of n_columns values of dtype.
+    ASCII files, used when n_columns is None, are memory mapped and parsed
+    a chunk of lines at a time, skipping the '#' header. All histograms are
+    filled in a single pass, and chunks can be spread over a thread pool
+    where each thread fills private histograms merged at the end.
+    """
+
+    def __init__(self, histograms, n_columns=None, dtype="float64",
+                 header_bytes=0, chunk_size=1000000, threads=1):
+        """
+        :param histograms: Histograms to fill from the event file
+        :type histograms: list of Histogram
+
+        :param n_columns: Number of variables per event in binary file, ASCII if None
+        :type n_columns: int
+
+        :param dtype: Data type of values in binary file
+        :type dtype: str
+
+        :param header_bytes: Number of bytes before the events in binary file
+        :type header_bytes: int
+
+        :param chunk_size: Maximum number of events held in memory per thread
+        :type chunk_size: int
+
+        :param threads: Number of threads used for the reduction
+        :type threads: int
+        """
+        if isinstance(histograms, Histogram):
+            histograms = [histograms]
+        for histogram in histograms:
+            if not isinstance(histogram, Histogram):
+                raise ValueError("histograms must be a list of Histogram.")
+        names = [histogram.name for histogram in histograms]
+        if len(set(names)) != len(names):
+            raise ValueError("Histogram names must be unique.")
+        self.histograms = list(histograms)
+
+        if n_columns is not None and (not isinstance(n_columns, int) or n_columns <= 0):
+            raise ValueError("n_columns must be a positive integer.")
+        self.n_columns = n_columns
+        self.dtype = np.dtype(dtype)
+
+        if not isinstance(header_bytes, int) or header_bytes < 0:
+            raise ValueError("header_bytes must be a non-negative integer.")
+        self.header_bytes = header_bytes
+
+        if not isinstance(chunk_size, int) or chunk_size <= 0:
+            raise ValueError("chunk_size must be a positive integer.")
+        self.chunk_size = chunk_size
+
+        if not isinstance(threads, int) or threads <= 0:
+            raise ValueError("threads must be a positive integer.")
+        self.threads = threads
+
+    def reduce(self, path):
+        """
+        Fills new histograms from the event file at path
+
+        :param path: Path to the event file
+        :type path: str
+
+        :return: dict from histogram name to filled Histogram
+        """
+        if not os.path.isfile(path):
+            raise ValueError("Event file not found: " + str(path))
+
+        result = [histogram.empty_copy() for histogram in self.histograms]
+        if os.path.getsize(path) == 0:
+            return {histogram.name: histogram for histogram in result}
+
+        with open(path, "rb") as file_handle:
+            with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if self.n_columns is None:
+                    chunks = self._ascii_chunks(mapped)
+                    read_chunk = lambda chunk: _parse_ascii(mapped, *chunk)
+                else:
+                    events = self._binary_events(mapped)
+                    chunks = [(start, min(start + self.chunk_size, events.shape[0]))
+                              for start in range(0, events.shape[0], self.chunk_size)]
+                    read_chunk = lambda chunk: events[chunk[0]:chunk[1]]
+
+                def work(worker_chunks):
+                    private = [histogram.empty_copy() for histogram in self.histograms]
+                    for chunk in worker_chunks:
+                        block = np.asarray(read_chunk(chunk))
+                        for histogram in private:
+                            histogram.accumulate(block)
+                    return private
+
+                if self.threads == 1 or len(chunks) <= 1:
+                    partials = [work(chunks)]
+                else:
+                    with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                        partials = list(pool.map(work, [chunks[i::self.threads]
+                                                        for i in range(self.threads)]))
+
+                # Views into the map must be gone before it is closed
+                events = None
+
+        for private in partials:
+            for histogram, partial in zip(result, private):
+                histogram.merge(partial)
+
+        return {histogram.name: histogram for histogram in result}
+
+    def _binary_events(self, mapped):
+        row_bytes = self.dtype.itemsize*self.n_columns
+        n_events = (len(mapped) - self.header_bytes) // row_bytes
+        return np.ndarray((n_events, self.n_columns), dtype=self.dtype,
+                          buffer=mapped, offset=self.header_bytes)
+
+    def _ascii_chunks(self, mapped):
+        """
+        Splits the data lines of an ASCII event file into byte ranges
+
+        Chunk boundaries are placed on line ends, with the size estimated from
+        the first data line so each chunk holds about chunk_size events.
+        """
+        start = 0
+        while start < len(mapped) and mapped[start:start + 1] in (b"#", b"\n"):
+            line_end = mapped.find(b"\n", start)
+            start = len(mapped) if line_end == -1 else line_end + 1
+
+        first_end = mapped.find(b"\n", start)
+        line_bytes = (len(mapped) if first_end == -1 else first_end + 1) - start
+        chunk_bytes = max(line_bytes, 1)*self.chunk_size
+
+        chunks = []
+        while start < len(mapped):
+            end = mapped.find(b"\n", min(start + chunk_bytes, len(mapped)) - 1)
+            end = len(mapped) if end == -1 else end + 1
+            chunks.append((start, end))
+            start = end
+
+        return chunks
+
+
+def _parse_ascii(mapped, start, end):
+    """ Parses event lines in the byte range [start, end) of a mapped file """
+    events = np.loadtxt(io.BytesIO(mapped[start:end]), comments="#", ndmin=2)
+    return events
@@ -2,9 +2,21 @@
 Using some simplified AbstractBase classes for Calculator and Parameter from SimEx
 """
 
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
 import AbstractBaseClass
 import AbstractBaseCalculator
 import mcstasscript
+from mcstasscript.helper import managed_mcrun
+from mcstasscript.interface import functions
+
+import ComponentStaging
+import MonitorAccumulation
+import RunTelemetry
 
 class McStasCalculator(AbstractBaseCalculator.AbstractBaseCalculator):
     def __init__(self, parameters=None, input_path=None, output_path=None):
@@ -24,20 +36,228 @@ class McStasCalculator(AbstractBaseCalculator.AbstractBaseCalculator):
 
         super(McStasCalculator, self).__init__(parameters, input_path, output_path)
 
+        # Runs use a view of the content addressed stage if requested
+        self.stage = None
+        if parameters.stage_folder is not None:
+            self.stage = ComponentStaging.ComponentStage(parameters.stage_folder)
+
+        # Histograms from event files, filled after each run
+        self.histograms = {}
+
     def backengine(self):
         instr = self.parameters.instrument
-        pars = self.parameters.pars
 
         ncount = self.parameters.ncount
         mpi = self.parameters.mpi
-        increment_folder_name = self.parameters.increment_folder_name
 
-        data = instr.run_full_instrument(parameters=pars, foldername=self.output_path,
-                                         mpi=mpi, increment_folder_name=increment_folder_name,
-                                         ncount=ncount)
+        if mpi == "auto":
+            mpi = self.estimate_cost()["mpi"]
+
+        # In append mode new rays are traced in a separate folder and folded into output_path
+        existing_result = self.parameters.append and os.path.isdir(self.output_path)
+        if self.parameters.append:
+            configuration = self._configuration()
+        if existing_result:
+            # Refuse before tracing rays that could not be folded in
+            MonitorAccumulation.check_configuration(self.output_path, configuration)
+            MonitorAccumulation.accumulated_ncount(self.output_path)
+
+            foldername = tempfile.mkdtemp(prefix=os.path.basename(self.output_path) + "_append_",
+                                          dir=os.path.dirname(self.output_path))
+            # mcrun refuses to write into an existing folder
+            os.rmdir(foldername)
+        elif self.parameters.append:
+            foldername = self.output_path
+        else:
+            foldername = self._next_output_folder()
+
+        start_time = time.perf_counter()
+        data = self._run_instrument(foldername, mpi)
+        wall_time = time.perf_counter() - start_time
+
+        telemetry = self._telemetry()
+        if telemetry is not None:
+            fingerprint = RunTelemetry.instrument_fingerprint(instr)
+            telemetry.record(fingerprint, mpi, ncount, wall_time)
+
+        if not self.parameters.append:
+            self.histograms = self._reduce_events(foldername)
+            return data
+
+        # McStas may trace a different number of rays than requested, for
+        # example rounded to a multiple of the MPI ranks
+        traced_ncount = MonitorAccumulation.accumulated_ncount(foldername)
+
+        if not existing_result:
+            # First run of an accumulation starts the ray count
+            self.histograms = self._reduce_events(self.output_path)
+            MonitorAccumulation.write_accumulation(self.output_path, traced_ncount, 1,
+                                                   configuration)
+            return data
+
+        # Event histograms cover the rays traced in this run
+        self.histograms = self._reduce_events(foldername)
+        try:
+            MonitorAccumulation.fold_results(self.output_path, foldername, traced_ncount,
+                                             configuration)
+        except Exception as error:
+            raise RuntimeError("Could not fold new rays into " + self.output_path
+                               + ", the result is unchanged and the new run is kept in "
+                               + foldername) from error
+        shutil.rmtree(foldername, ignore_errors=True)
+
+        return self._load_monitors(self.output_path)
+
+    def _configuration(self):
+        """ Instrument file hash and pars identifying runs that may be accumulated """
+        return {"fingerprint": MonitorAccumulation.instrument_hash(self.parameters.instrument),
+                "pars": self.parameters.pars}
+
+    def _run_instrument(self, foldername, mpi):
+        """
+        Runs the instrument, from a staged view of input_path if a stage is used
+
+        The instrument input_path is only pointed at the view during the run,
+        so the source folder is what gets staged the next time.
+        """
+        instr = self.parameters.instrument
+        if len(self.parameters.event_reducers) == 0:
+            run = lambda: instr.run_full_instrument(parameters=self.parameters.pars,
+                                                    foldername=foldername, mpi=mpi,
+                                                    increment_folder_name=False,
+                                                    ncount=self.parameters.ncount)
+        else:
+            run = lambda: self._run_without_event_files(foldername, mpi)
+
+        if self.stage is None:
+            return run()
+
+        source_path = instr.input_path
+        generated = [instr.name + extension for extension in (".instr", ".c", ".out")]
+        view_path = self.stage.stage(source_path, exclude=[self.output_path],
+                                     generated=generated)
+        instr.input_path = view_path
+        try:
+            return run()
+        finally:
+            instr.input_path = source_path
+            self.stage.release(view_path)
+
+    def _run_without_event_files(self, foldername, mpi):
+        """
+        Runs the instrument as run_full_instrument does, without loading event files
+
+        run_full_instrument loads every monitor listed in mccode.sim with
+        numpy.loadtxt, which would read the full event lists into memory
+        before the event reducers stream them. Here the monitors are loaded
+        one by one, leaving out the files handled by the event reducers.
+        """
+        instr = self.parameters.instrument
+        instr.write_full_instrument()
+
+        simulation = managed_mcrun.ManagedMcrun(instr.name + ".instr",
+                                                foldername=foldername,
+                                                mcrun_path=instr.mcrun_path,
+                                                run_path=instr.input_path,
+                                                parameters=self.parameters.pars,
+                                                mpi=mpi,
+                                                ncount=self.parameters.ncount,
+                                                increment_folder_name=False)
+        simulation.run_simulation()
+
+        return self._load_monitors(foldername)
+
+    def _load_monitors(self, folder):
+        """
+        Loads the monitors in folder, except the files handled by event reducers
+        """
+        if len(self.parameters.event_reducers) == 0:
+            return functions.load_data(folder)
+
+        event_files = set(self.parameters.event_reducers)
+        data = []
+        for metadata in managed_mcrun.load_metadata(folder):
+            if metadata.filename.strip() in event_files:
+                continue
+            data.append(managed_mcrun.load_monitor(metadata, folder))
 
         return data
 
+    def estimate_cost(self):
+        """
+        Dry run estimate of the run from recorded telemetry
+
+        Predicts wall time for the parameters ncount and mpi, and chooses
+        the rank count when mpi is "auto". Until enough runs of the
+        instrument are recorded to fit the model, wall_time and
+        core_seconds are None and "auto" picks rank counts that complete
+        the telemetry, see RunTelemetry.predict.
+
+        :return: dict with mpi, ncount, wall_time and core_seconds
+        """
+        ncount = self.parameters.ncount
+        mpi = self.parameters.mpi
+
+        telemetry = self._telemetry()
+        if telemetry is None:
+            if mpi == "auto":
+                mpi = self.parameters.max_mpi or os.cpu_count() or 1
+            return {"mpi": mpi, "ncount": ncount, "wall_time": None, "core_seconds": None}
+
+        fingerprint = RunTelemetry.instrument_fingerprint(self.parameters.instrument)
+        estimate = telemetry.predict(fingerprint, ncount, mpi=None if mpi == "auto" else mpi)
+        estimate["ncount"] = ncount
+
+        return estimate
+
+    def _telemetry(self):
+        if self.parameters.telemetry_file is None:
+            return None
+
+        return RunTelemetry.RunTelemetry(self.parameters.telemetry_file,
+                                         max_mpi=self.parameters.max_mpi)
+
+    def _reduce_events(self, folder):
+        """
+        Streams the event files in folder into the requested histograms
+
+        Event files that were not written, for example when a monitor is
+        not reached, are reported with a warning and left out.
+
+        :return: dict from event file name to dict of filled histograms
+        """
+        event_reducers = self.parameters.event_reducers
+        if len(event_reducers) == 0:
+            return {}
+
+        histograms = {}
+        for file_name, reducer in event_reducers.items():
+            path = os.path.join(folder, file_name)
+            if not os.path.isfile(path):
+                warnings.warn("Event file " + path + " was not written by the run.")
+                continue
+            histograms[file_name] = reducer.reduce(path)
+
+        return histograms
+
+    def _next_output_folder(self):
+        """
+        Returns the folder the next run writes to
+
+        Follows McStasScript, which with increment_folder_name uses the first
+        free of output_path_0, output_path_1, ... when output_path exists.
+        The folder is chosen here so the run can be told exactly where to
+        write and its files found afterwards.
+        """
+        if not os.path.exists(self.output_path) or not self.parameters.increment_folder_name:
+            return self.output_path
+
+        counter = 0
+        while os.path.isdir(self.output_path + "_" + str(counter)):
+            counter += 1
+
+        return self.output_path + "_" + str(counter)
+
     def expectedData(self):
         pass
 
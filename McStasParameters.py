@@ -3,6 +3,7 @@ import os
 from mcstasscript.interface import instr
 
 from AbstractCalculatorParameters import AbstractCalculatorParameters
+from EventHistogram import EventReducer
 from EntityChecks import checkAndSetInstance
 
 class McStasParameters(AbstractCalculatorParameters):
@@ -27,8 +28,20 @@ class McStasParameters(AbstractCalculatorParameters):
         self.mpi = 1
         if "mpi" in kwargs:
             self.mpi = kwargs["mpi"]
-            if not isinstance(self.mpi, int):
-                raise ValueError("Number of cores to use, mpi, must be an integer.")
+            if not isinstance(self.mpi, int) and self.mpi != "auto":
+                raise ValueError("Number of cores to use, mpi, must be an integer or \"auto\".")
+
+        self.max_mpi = None
+        if "max_mpi" in kwargs:
+            self.max_mpi = kwargs["max_mpi"]
+            if self.max_mpi is not None and not isinstance(self.max_mpi, int):
+                raise ValueError("Maximum number of cores for mpi=\"auto\", max_mpi, must be an integer.")
+
+        self.telemetry_file = None
+        if "telemetry_file" in kwargs:
+            self.telemetry_file = kwargs["telemetry_file"]
+            if self.telemetry_file is not None and not isinstance(self.telemetry_file, str):
+                raise ValueError("telemetry_file for run times, must be a string.")
 
         self.ncount = 1E6
         if "ncount" in kwargs:
@@ -42,12 +55,33 @@ class McStasParameters(AbstractCalculatorParameters):
             if not isinstance(self.increment_folder_name, bool):
                 raise ValueError("Increment foldername mode, must be an bool.")
 
+        self.append = False
+        if "append" in kwargs:
+            self.append = kwargs["append"]
+            if not isinstance(self.append, bool):
+                raise ValueError("Append mode, must be an bool.")
+
         self.custom_flags = ""
         if "custom_flags" in kwargs:
             self.custom_flags = kwargs["custom_flags"]
             if not isinstance(self.custom_flags, str):
                 raise ValueError("custom_flags for McStas, must be a string.")
 
+        self.stage_folder = None
+        if "stage_folder" in kwargs:
+            self.stage_folder = kwargs["stage_folder"]
+            if self.stage_folder is not None and not isinstance(self.stage_folder, str):
+                raise ValueError("stage_folder for input files, must be a string.")
+
+        self.event_reducers = {}
+        if "event_reducers" in kwargs:
+            self.event_reducers = kwargs["event_reducers"]
+            if not isinstance(self.event_reducers, dict):
+                raise ValueError("event_reducers must be a dict from event file name to EventReducer.")
+            for reducer in self.event_reducers.values():
+                if not isinstance(reducer, EventReducer):
+                    raise ValueError("event_reducers must be a dict from event file name to EventReducer.")
+
 
     def _setDefaults(self):
         """ Set default for required inherited parameters. """
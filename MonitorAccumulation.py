@@ -0,0 +1,566 @@
+"""
+Folding of McStas monitor results from repeated runs of the same configuration
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+ACCUMULATION_FILE = "accumulation.json"
+
+_NCOUNT_PATTERN = re.compile(r"^(\s*#?\s*Ncount:\s*)(\S+)(.*)$")
+_VALUES_PATTERN = re.compile(r"^(\s*#\s*values:\s*)(.*)$")
+_SIM_VALUES_PATTERN = re.compile(r"^(\s*values:\s*)(.*)$")
+_SIM_FILENAME_PATTERN = re.compile(r"^\s*filename:\s*(\S+)")
+_SIM_PARAM_PATTERN = re.compile(r"^\s*Param:\s*([^=\s]+)\s*=\s*(.*?)\s*$")
+_TYPE_PATTERN = re.compile(r"^\s*#\s*type:\s*array_(\d)d")
+
+
+def read_accumulation(folder):
+    """
+    Returns the content of the accumulation file in folder, None if missing
+
+    :return: dict with ncount, runs and the configuration of the runs
+    """
+    accumulation_file = os.path.join(folder, ACCUMULATION_FILE)
+    if not os.path.isfile(accumulation_file):
+        return None
+    with open(accumulation_file, "r") as file_handle:
+        return json.load(file_handle)
+
+
+def write_accumulation(folder, ncount, runs, configuration=None):
+    """
+    Records total number of rays and runs accumulated in folder
+
+    :param configuration: Instrument fingerprint and pars the result belongs to
+    :type configuration: dict
+    """
+    _write_atomic(os.path.join(folder, ACCUMULATION_FILE),
+                  json.dumps({"ncount": float(ncount), "runs": int(runs),
+                              "configuration": _normalize(configuration)}))
+
+
+def accumulated_ncount(folder):
+    """
+    Returns the number of rays accumulated in a result folder
+
+    Read from the accumulation file written by fold_results, or for a
+    folder written by a single McStas run, from mccode.sim or the Ncount
+    attribute in an HDF5 result.
+
+    :param folder: McStas result folder
+    :type folder: str
+
+    :return: Total number of rays as float
+    """
+    accumulation = read_accumulation(folder)
+    if accumulation is not None:
+        return float(accumulation["ncount"])
+
+    sim_file = os.path.join(folder, "mccode.sim")
+    if os.path.isfile(sim_file):
+        with open(sim_file, "r") as file_handle:
+            for line in file_handle:
+                match = _NCOUNT_PATTERN.match(line)
+                if match:
+                    return float(match.group(2))
+
+    for h5_file in _hdf5_files(folder):
+        ncount = _hdf5_ncount(h5_file)
+        if ncount is not None:
+            return ncount
+
+    raise ValueError("Could not find number of accumulated rays in " + folder)
+
+
+def instrument_hash(instrument):
+    """
+    Returns a hash of the instrument file McStasScript writes for instrument
+
+    Unlike the layout fingerprint used for telemetry, this covers every
+    component parameter, position and code section, so results are only
+    accumulated for the exact same instrument. The file is written to a
+    temporary folder, and its Date line, the only part changing between
+    writes, is left out of the hash.
+    """
+    input_path = instrument.input_path
+    folder = tempfile.mkdtemp()
+    try:
+        instrument.input_path = folder
+        instrument.write_full_instrument()
+        with open(os.path.join(folder, instrument.name + ".instr"), "r") as file_handle:
+            lines = [line for line in file_handle if not line.startswith("* Date:")]
+    finally:
+        instrument.input_path = input_path
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return hashlib.sha256("".join(lines).encode()).hexdigest()
+
+
+def check_configuration(folder, configuration):
+    """
+    Raises ValueError if the result in folder is from another configuration
+
+    The configuration stored by write_accumulation is compared in full. For
+    a folder written by a single McStas run only the instrument parameters
+    recorded by McStas can be compared, where parameters missing from pars
+    are taken to be at their default values.
+
+    :param configuration: dict with the instrument fingerprint and pars
+    :type configuration: dict
+    """
+    if configuration is None:
+        return
+
+    accumulation = read_accumulation(folder)
+    if accumulation is not None and accumulation.get("configuration") is not None:
+        if accumulation["configuration"] != _normalize(configuration):
+            raise ValueError("Result in " + folder + " was made with another instrument or "
+                             + "pars, " + str(accumulation["configuration"]["pars"])
+                             + " instead of " + str(configuration["pars"]) + ".")
+        return
+
+    stored_pars = _stored_pars(folder)
+    if stored_pars is None:
+        return
+    # Parameters only in the stored result were left at their defaults
+    pars = configuration["pars"]
+    if any(name not in stored_pars or not _same_value(stored_pars[name], pars[name])
+           for name in pars):
+        raise ValueError("Result in " + folder + " was made with pars " + str(stored_pars)
+                         + " instead of " + str(pars) + ".")
+
+
+def fold_results(folder, new_folder, new_ncount, configuration=None):
+    """
+    Folds the monitors of a new run into an existing result folder
+
+    McStas normalizes intensities by the number of rays, so results from
+    n_old and n_new rays combine as
+
+        I = (n_old*I_old + n_new*I_new)/(n_old + n_new)
+        E = sqrt(n_old^2*E_old^2 + n_new^2*E_new^2)/(n_old + n_new)
+
+    with event counts summed. ASCII monitor files and HDF5 files are folded,
+    event lists without error sums are left untouched. All files are folded
+    in a copy of folder which replaces folder only when every file
+    succeeded, so a failure leaves the existing result as it was. An
+    exclusive lock on folder.lock is held throughout, so simultaneous folds
+    into the same folder are applied one after the other.
+
+    :param folder: Existing result folder
+    :type folder: str
+
+    :param new_folder: Result folder of the new run
+    :type new_folder: str
+
+    :param new_ncount: Number of rays in the new run
+    :type new_ncount: int or float
+
+    :param configuration: Instrument fingerprint and pars of the new run
+    :type configuration: dict
+
+    :return: Total number of accumulated rays
+    """
+    folder = os.path.abspath(folder)
+    # Next to folder, as folder itself is replaced
+    with open(folder + ".lock", "a") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            return _fold_results(folder, new_folder, new_ncount, configuration)
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+
+def _fold_results(folder, new_folder, new_ncount, configuration):
+    """ Folds new_folder into folder, holding the lock on folder """
+    check_configuration(folder, configuration)
+
+    old_ncount = accumulated_ncount(folder)
+    total_ncount = old_ncount + new_ncount
+
+    accumulation = read_accumulation(folder)
+    runs = 1 if accumulation is None else accumulation.get("runs", 1)
+    if configuration is None and accumulation is not None:
+        configuration = accumulation.get("configuration")
+
+    work_folder = tempfile.mkdtemp(prefix=os.path.basename(folder) + "_fold_",
+                                   dir=os.path.dirname(folder))
+    try:
+        # Unchanged files are hardlinked, folded files are written as new files
+        _link_tree(folder, work_folder)
+
+        monitor_values = {}
+        for file_name in sorted(os.listdir(new_folder)):
+            new_file = os.path.join(new_folder, file_name)
+            work_file = os.path.join(work_folder, file_name)
+            if not os.path.isfile(work_file):
+                continue
+
+            if file_name.endswith((".h5", ".nxs")):
+                # Folded in place, so the link to the existing file is broken first
+                shutil.copyfile(os.path.join(folder, file_name), work_file + ".copy")
+                os.replace(work_file + ".copy", work_file)
+                fold_hdf5(work_file, new_file, old_ncount, new_ncount)
+            elif file_name.endswith(".dat"):
+                values = fold_ascii(work_file, new_file, old_ncount, new_ncount)
+                if values is not None:
+                    monitor_values[file_name] = values
+
+        sim_file = os.path.join(work_folder, "mccode.sim")
+        if os.path.isfile(sim_file):
+            _update_sim(sim_file, total_ncount, monitor_values)
+
+        write_accumulation(work_folder, total_ncount, runs + 1, configuration)
+    except BaseException:
+        shutil.rmtree(work_folder, ignore_errors=True)
+        raise
+
+    old_folder = work_folder + "_old"
+    os.rename(folder, old_folder)
+    os.rename(work_folder, folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+
+    return total_ncount
+
+
+def fold_ascii(old_file, new_file, old_ncount, new_ncount):
+    """
+    Folds a McStas ASCII monitor file into old_file in place
+
+    Handles 0D monitors (values line only), 1D monitors (columns x, I,
+    I_err, N) and 2D monitors (Data, Errors and Events blocks). Files
+    without error information, such as event lists, are left unchanged.
+
+    :return: Folded total (I, E, N) of the monitor, None if not folded
+    """
+    old_header, old_blocks = _read_ascii(old_file)
+    dimension = _dimension(old_header)
+    total_ncount = old_ncount + new_ncount
+
+    # Event lists hold a different number of rows for each run, so they are
+    # recognized by their layout before the binning of the runs is compared
+    if dimension == 0:
+        binned = (_values(old_header) is not None
+                  and all(block.shape == (1, 3) for block in old_blocks))
+    elif dimension == 1:
+        binned = len(old_blocks) == 1 and old_blocks[0].shape[1] == 4
+    else:
+        binned = len(old_blocks) == 3
+    if not binned:
+        return None
+
+    new_header, new_blocks = _read_ascii(new_file)
+    if [block.shape for block in new_blocks] != [block.shape for block in old_blocks]:
+        raise ValueError("Monitor binning differs between runs in " + old_file)
+
+    if dimension == 0:
+        old_values = _values(old_header)
+        new_values = _values(new_header)
+        if new_values is None:
+            raise ValueError("Monitor values missing in " + new_file)
+        intensity, error, events = _combine(old_values[0], old_values[1], old_values[2],
+                                            new_values[0], new_values[1], new_values[2],
+                                            old_ncount, new_ncount)
+        values = (intensity, error, events)
+        blocks = [np.array([values])]*len(old_blocks)
+
+    elif dimension == 1:
+        old_data, new_data = old_blocks[0], new_blocks[0]
+        intensity, error, events = _combine(old_data[:, 1], old_data[:, 2], old_data[:, 3],
+                                            new_data[:, 1], new_data[:, 2], new_data[:, 3],
+                                            old_ncount, new_ncount)
+        data = np.column_stack((old_data[:, 0], intensity, error, events))
+        values = (intensity.sum(), np.sqrt(np.sum(error**2)), events.sum())
+        blocks = [data]
+
+    else:
+        intensity, error, events = _combine(*old_blocks, *new_blocks, old_ncount, new_ncount)
+        values = (intensity.sum(), np.sqrt(np.sum(error**2)), events.sum())
+        blocks = [intensity, error, events]
+
+    lines = []
+    block_index = 0
+    for line in old_header:
+        if line is None:
+            # Placeholder for the numbers of the next data block
+            lines.extend(_format_row(row) for row in blocks[block_index])
+            block_index += 1
+            continue
+        ncount_match = _NCOUNT_PATTERN.match(line)
+        values_match = _VALUES_PATTERN.match(line)
+        if ncount_match:
+            line = ncount_match.group(1) + _format_number(total_ncount) + ncount_match.group(3)
+        elif values_match:
+            line = values_match.group(1) + " ".join(_format_number(value) for value in values)
+        lines.append(line)
+
+    _write_atomic(old_file, "\n".join(lines) + "\n")
+    return values
+
+
+def fold_hdf5(old_file, new_file, old_ncount, new_ncount):
+    """
+    Folds a McStas HDF5/NeXus file into old_file in place
+
+    Every group holding both a data and an errors dataset is treated as a
+    monitor, with events taken from an events or ncount dataset in the same
+    group. Ncount attributes anywhere in the file are set to the total
+    number of rays, which is also stored as an attribute of the file.
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is needed to accumulate HDF5 results.")
+
+    total_ncount = old_ncount + new_ncount
+
+    with h5py.File(old_file, "r+") as old_h5, h5py.File(new_file, "r") as new_h5:
+        monitors = []
+        old_h5.visititems(lambda name, item: monitors.append(name)
+                          if isinstance(item, h5py.Group) and "data" in item and "errors" in item
+                          else None)
+
+        for name in monitors:
+            if name not in new_h5:
+                continue
+            old_group, new_group = old_h5[name], new_h5[name]
+            if (old_group["data"].shape != new_group["data"].shape
+                    or old_group["errors"].shape != new_group["errors"].shape):
+                raise ValueError("Monitor binning differs between runs in "
+                                 + old_file + ":" + name)
+            events_name = "events" if "events" in old_group else "ncount"
+            has_events = events_name in old_group and events_name in new_group
+
+            old_events = old_group[events_name][()] if has_events else 0
+            new_events = new_group[events_name][()] if has_events else 0
+            intensity, error, events = _combine(old_group["data"][()], old_group["errors"][()],
+                                                old_events,
+                                                new_group["data"][()], new_group["errors"][()],
+                                                new_events,
+                                                old_ncount, new_ncount)
+            old_group["data"][...] = intensity
+            old_group["errors"][...] = error
+            if has_events:
+                old_group[events_name][...] = events
+
+        def update_ncount(name, item):
+            if "Ncount" in item.attrs:
+                item.attrs["Ncount"] = _format_number(total_ncount)
+        old_h5.visititems(update_ncount)
+        old_h5.attrs["Ncount"] = total_ncount
+
+
+def _combine(old_intensity, old_error, old_events,
+             new_intensity, new_error, new_events, old_ncount, new_ncount):
+    """ ncount weighted sum of intensities with errors added in quadrature """
+    total_ncount = old_ncount + new_ncount
+    intensity = (old_ncount*np.asarray(old_intensity) + new_ncount*np.asarray(new_intensity))/total_ncount
+    error = np.sqrt((old_ncount*np.asarray(old_error))**2
+                    + (new_ncount*np.asarray(new_error))**2)/total_ncount
+    events = np.asarray(old_events) + np.asarray(new_events)
+    return intensity, error, events
+
+
+def _read_ascii(path):
+    """
+    Reads a McStas ASCII file into header lines and numeric blocks
+
+    The returned header keeps all comment lines with None in place of each
+    block of numbers, so the file can be written back with new numbers.
+    """
+    header = []
+    blocks = []
+    rows = []
+    with open(path, "r") as file_handle:
+        for line in file_handle:
+            line = line.rstrip("\n")
+            if line.strip() == "" or line.lstrip().startswith("#"):
+                if rows:
+                    blocks.append(np.array(rows, dtype=float))
+                    rows = []
+                header.append(line)
+            else:
+                if not rows:
+                    header.append(None)
+                rows.append([float(value) for value in line.split()])
+    if rows:
+        blocks.append(np.array(rows, dtype=float))
+
+    return header, blocks
+
+
+def _dimension(header):
+    for line in header:
+        if line is None:
+            continue
+        match = _TYPE_PATTERN.match(line)
+        if match:
+            return int(match.group(1))
+    return 0
+
+
+def _values(header):
+    for line in header:
+        if line is None:
+            continue
+        match = _VALUES_PATTERN.match(line)
+        if match:
+            return [float(value) for value in match.group(2).split()[:3]]
+    return None
+
+
+def _update_sim(path, total_ncount, monitor_values):
+    """
+    Updates Ncount lines and the values lines of folded monitors in mccode.sim
+    """
+    lines = []
+    block = None
+    with open(path, "r") as file_handle:
+        for line in file_handle:
+            line = line.rstrip("\n")
+            match = _NCOUNT_PATTERN.match(line)
+            if match:
+                line = match.group(1) + _format_number(total_ncount) + match.group(3)
+
+            if line.strip().startswith("begin data"):
+                block = []
+            if block is None:
+                lines.append(line)
+                continue
+
+            block.append(line)
+            if line.strip().startswith("end data"):
+                lines.extend(_update_sim_block(block, monitor_values))
+                block = None
+
+    if block is not None:
+        lines.extend(block)
+
+    _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _update_sim_block(block, monitor_values):
+    values = None
+    for line in block:
+        match = _SIM_FILENAME_PATTERN.match(line)
+        if match:
+            values = monitor_values.get(match.group(1))
+    if values is None:
+        return block
+
+    updated = []
+    for line in block:
+        match = _SIM_VALUES_PATTERN.match(line)
+        if match:
+            line = match.group(1) + " ".join(_format_number(value) for value in values)
+        updated.append(line)
+    return updated
+
+
+def _stored_pars(folder):
+    """ Instrument parameters recorded by McStas in mccode.sim or mccode.h5 """
+    sim_file = os.path.join(folder, "mccode.sim")
+    if os.path.isfile(sim_file):
+        pars = {}
+        with open(sim_file, "r") as file_handle:
+            for line in file_handle:
+                match = _SIM_PARAM_PATTERN.match(line)
+                if match:
+                    pars[match.group(1)] = match.group(2)
+        return pars
+
+    h5_file = os.path.join(folder, "mccode.h5")
+    if os.path.isfile(h5_file):
+        import h5py
+        with h5py.File(h5_file, "r") as h5:
+            if "entry1/simulation/Param" not in h5:
+                return None
+            attributes = h5["entry1/simulation/Param"].attrs
+            return {name: _decode(attributes[name]) for name in attributes
+                    if name != "NX_class"}
+
+    return None
+
+
+def _same_value(stored, value):
+    """ Compares a parameter value read back from McStas output with a par """
+    stored = str(_decode(stored)).strip().strip("\"'")
+    try:
+        return float(stored) == float(value)
+    except (TypeError, ValueError):
+        return stored == str(value).strip("\"'")
+
+
+def _hdf5_files(folder):
+    return [os.path.join(folder, file_name) for file_name in sorted(os.listdir(folder))
+            if file_name.endswith((".h5", ".nxs"))]
+
+
+def _hdf5_ncount(path):
+    """ Ncount attribute of the file, or the first found on any of its items """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is needed to accumulate HDF5 results.")
+
+    with h5py.File(path, "r") as h5:
+        if "Ncount" in h5.attrs:
+            return float(_decode(h5.attrs["Ncount"]))
+
+        found = []
+        h5.visititems(lambda name, item: found.append(item.attrs["Ncount"])
+                      if "Ncount" in item.attrs and not found else None)
+        if found:
+            return float(_decode(found[0]))
+
+    return None
+
+
+def _decode(value):
+    if isinstance(value, np.ndarray) and value.size == 1:
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def _normalize(configuration):
+    """ Configuration as it reads back from json, so stored and new compare equal """
+    if configuration is None:
+        return None
+    return json.loads(json.dumps(configuration, sort_keys=True, default=str))
+
+
+def _link_tree(source, target):
+    """ Recreates the files of source in the existing folder target as hardlinks """
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(target_root, exist_ok=True)
+        for file_name in files:
+            try:
+                os.link(os.path.join(root, file_name), os.path.join(target_root, file_name))
+            except OSError:
+                shutil.copy2(os.path.join(root, file_name), os.path.join(target_root, file_name))
+
+
+def _format_number(value):
+    return "%.10g" % value
+
+
+def _format_row(row):
+    return " ".join(_format_number(value) for value in np.atleast_1d(row))
+
+
+def _write_atomic(path, text):
+    handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(handle, "w") as file_handle:
+        file_handle.write(text)
+    os.replace(temporary_path, path)
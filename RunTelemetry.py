@@ -0,0 +1,239 @@
+"""
+Runtime telemetry of McStas runs used to choose mpi and predict wall time
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+class RunTelemetry:
+    """
+    Records wall time of runs for each instrument and predicts new runs
+
+    The wall time of a run with n ranks and ncount rays is modelled as
+
+        t = startup + startup_per_rank*n + ncount/(rays_per_second_per_rank*n)
+
+    where the first two terms cover compilation and MPI startup, and the
+    last the ray tracing. The coefficients are fitted with non-negative
+    least squares to the recorded runs of an instrument fingerprint. They
+    can only be told apart once the runs span three independent
+    combinations of ranks and rays, until then the rank counts to try are
+    chosen to get there, and no wall time is predicted. scipy is only
+    needed once a model is fitted.
+    """
+
+    max_records = 200
+    compact_bytes = 2 << 20
+
+    def __init__(self, telemetry_file, max_mpi=None):
+        """
+        :param telemetry_file: JSON lines file storing the telemetry, created if missing
+        :type telemetry_file: str
+
+        :param max_mpi: Largest number of ranks considered, cpu count if None
+        :type max_mpi: int
+        """
+        if not isinstance(telemetry_file, str):
+            raise ValueError("telemetry_file must be a string.")
+        self.telemetry_file = os.path.abspath(telemetry_file)
+
+        if max_mpi is None:
+            max_mpi = os.cpu_count() or 1
+        if not isinstance(max_mpi, int) or max_mpi <= 0:
+            raise ValueError("max_mpi must be a positive integer.")
+        self.max_mpi = max_mpi
+
+    def record(self, fingerprint, mpi, ncount, wall_time):
+        """
+        Stores the wall time of a finished run
+
+        Each run is appended as a line while holding a lock on the log, so
+        runs finishing at the same time do not overwrite each other. When
+        the log grows past compact_bytes it is cut to the last max_records
+        runs of each fingerprint.
+
+        :param fingerprint: Fingerprint of the instrument, see instrument_fingerprint
+        :type fingerprint: str
+
+        :param mpi: Number of ranks used
+        :type mpi: int
+
+        :param ncount: Number of rays
+        :type ncount: int or float
+
+        :param wall_time: Wall time of the run in seconds
+        :type wall_time: float
+        """
+        line = json.dumps({"fingerprint": fingerprint, "mpi": int(mpi),
+                           "ncount": float(ncount), "wall_time": float(wall_time),
+                           "time": time.time()}) + "\n"
+
+        os.makedirs(os.path.dirname(self.telemetry_file), exist_ok=True)
+        with open(self.telemetry_file + ".lock", "a") as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            try:
+                # Opened under the lock, so a compaction never loses this line
+                with open(self.telemetry_file, "a") as file_handle:
+                    file_handle.write(line)
+                self._compact()
+            finally:
+                fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+    def runs(self, fingerprint):
+        """
+        Returns the last max_records runs recorded for fingerprint
+
+        :return: list of dict with mpi, ncount, wall_time and time
+        """
+        return self._read_runs().get(fingerprint, [])
+
+    def model(self, fingerprint):
+        """
+        Fits the wall time model to the runs recorded for fingerprint
+
+        :return: dict with startup, startup_per_rank and
+                 rays_per_second_per_rank, or None while the recorded runs
+                 can not separate startup from ray tracing
+        """
+        return self._fit(self.runs(fingerprint))
+
+    def predict(self, fingerprint, ncount, mpi=None):
+        """
+        Predicts the wall time of a run, choosing the rank count if mpi is None
+
+        While the model can not be fitted, mpi is chosen among max_mpi, 1
+        and half of max_mpi ranks, taking the first not yet recorded, so
+        runs with mpi="auto" collect the data needed for the fit.
+
+        :param fingerprint: Fingerprint of the instrument
+        :type fingerprint: str
+
+        :param ncount: Number of rays
+        :type ncount: int or float
+
+        :param mpi: Number of ranks, best predicted in 1..max_mpi if None
+        :type mpi: int
+
+        :return: dict with mpi, wall_time and core_seconds, where wall_time
+                 and core_seconds are None while the model can not be fitted
+        """
+        runs = self.runs(fingerprint)
+        model = self._fit(runs)
+        if model is None:
+            if mpi is None:
+                mpi = self._exploration_mpi(runs)
+            return {"mpi": mpi, "wall_time": None, "core_seconds": None}
+
+        if mpi is None:
+            candidates = np.arange(1, self.max_mpi + 1)
+        else:
+            candidates = np.array([mpi])
+
+        wall_times = (model["startup"] + model["startup_per_rank"]*candidates
+                      + ncount/(model["rays_per_second_per_rank"]*candidates))
+        best = int(np.argmin(wall_times))
+
+        return {"mpi": int(candidates[best]),
+                "wall_time": float(wall_times[best]),
+                "core_seconds": float(wall_times[best]*candidates[best])}
+
+    def _fit(self, runs):
+        """
+        Fits the model to runs with non-negative least squares
+
+        With max_mpi below 3 only two rank counts can be tried, which can
+        not separate startup from startup_per_rank, so startup_per_rank is
+        left out of the fit.
+        """
+        if len(runs) == 0:
+            return None
+
+        from scipy.optimize import nnls
+
+        mpi = np.array([run["mpi"] for run in runs], dtype=float)
+        ncount = np.array([run["ncount"] for run in runs], dtype=float)
+        wall_time = np.array([run["wall_time"] for run in runs], dtype=float)
+
+        design = np.column_stack((np.ones_like(mpi), mpi, ncount/mpi))
+        if self.max_mpi < 3:
+            design = design[:, [0, 2]]
+        # Columns of very different size are scaled for a well conditioned fit
+        scale = design.max(axis=0)
+        design = design/scale
+        if np.linalg.matrix_rank(design) < design.shape[1]:
+            return None
+
+        coefficients = nnls(design, wall_time)[0]/scale
+        if self.max_mpi < 3:
+            coefficients = [coefficients[0], 0.0, coefficients[1]]
+        startup, per_rank, seconds_per_ray = coefficients
+        if seconds_per_ray <= 0:
+            return None
+
+        return {"startup": float(startup),
+                "startup_per_rank": float(per_rank),
+                "rays_per_second_per_rank": float(1.0/seconds_per_ray)}
+
+    def _exploration_mpi(self, runs):
+        recorded = {run["mpi"] for run in runs}
+        for mpi in (self.max_mpi, 1, (self.max_mpi + 1)//2):
+            if mpi not in recorded:
+                return mpi
+        return self.max_mpi
+
+    def _read_runs(self):
+        """
+        Reads the log into a dict from fingerprint to its last max_records runs
+        """
+        if not os.path.isfile(self.telemetry_file):
+            return {}
+
+        runs = {}
+        with open(self.telemetry_file, "r") as file_handle:
+            for line in file_handle:
+                try:
+                    run = json.loads(line)
+                except ValueError:
+                    # Line cut short by a crash while writing
+                    continue
+                runs.setdefault(run.get("fingerprint"), []).append(run)
+
+        return {fingerprint: fingerprint_runs[-self.max_records:]
+                for fingerprint, fingerprint_runs in runs.items()}
+
+    def _compact(self):
+        """ Rewrites the log with the last max_records runs per fingerprint, lock held """
+        if os.path.getsize(self.telemetry_file) <= self.compact_bytes:
+            return
+
+        kept = sorted((run for runs in self._read_runs().values() for run in runs),
+                      key=lambda run: run.get("time", 0))
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(self.telemetry_file))
+        with os.fdopen(handle, "w") as file_handle:
+            for run in kept:
+                file_handle.write(json.dumps(run) + "\n")
+        os.replace(temporary_path, self.telemetry_file)
+
+
+def instrument_fingerprint(instrument):
+    """
+    Returns a hash identifying the instrument layout
+
+    Uses the instrument name, its parameters and its components with their
+    types, so runs of the same instrument share telemetry while parameter
+    values, which rarely change the cost much, are ignored.
+    """
+    description = [instrument.name]
+    for parameter in instrument.parameter_list:
+        description.append("par:" + str(parameter.name))
+    for component in instrument.component_list:
+        description.append("comp:" + str(component.name) + ":" + str(component.component_name))
+
+    return hashlib.sha256("\n".join(description).encode()).hexdigest()
@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+import ComponentStaging
+
+GENERATED = ["demo.instr", "demo.c", "demo.out"]
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file_handle:
+        file_handle.write(text)
+
+
+def _files(folder):
+    return sorted(os.path.relpath(os.path.join(root, name), folder)
+                  for root, dirs, files in os.walk(folder) for name in files)
+
+
+def _objects(stage):
+    return _files(stage.objects_path)
+
+
+@pytest.fixture
+def source(tmp_path):
+    _write(str(tmp_path / "Union_master.comp"), '%{\n#include "Union_functions.c"\n%}')
+    _write(str(tmp_path / "Union_functions.c"), "shared functions")
+    _write(str(tmp_path / "Union_functions.h"), "shared declarations")
+    _write(str(tmp_path / "tables" / "reflectivity.dat"), "1 0.9")
+    _write(str(tmp_path / "notes.txt"), "read by a component")
+    for name in GENERATED:
+        _write(str(tmp_path / name), "generated by the run")
+    return tmp_path
+
+
+STAGED = ["Union_functions.c", "Union_functions.h", "Union_master.comp", "notes.txt",
+          os.path.join("tables", "reflectivity.dat")]
+
+
+def test_stage_round_trip(source):
+    stage = ComponentStaging.ComponentStage(str(source / "stage"))
+    view = stage.stage(str(source), generated=GENERATED)
+
+    assert _files(view) == STAGED
+    with open(os.path.join(view, "Union_functions.c")) as file_handle:
+        assert file_handle.read() == "shared functions"
+
+    stage.release(view)
+    assert not os.path.exists(view)
+
+
+def test_views_share_objects_and_skip_stage_folder(source):
+    stage = ComponentStaging.ComponentStage(str(source / "stage"))
+    views = [stage.stage(str(source), generated=GENERATED) for _ in range(3)]
+
+    for view in views:
+        assert _files(view) == STAGED
+    inodes = {os.stat(os.path.join(view, "Union_master.comp")).st_ino for view in views}
+    assert len(inodes) == 1
+    assert len(stage.index) == len(STAGED)
+
+
+def test_output_folders_are_skipped(source):
+    _write(str(source / "output" / "psd.dat"), "excluded output")
+    _write(str(source / "output_0" / "psd.dat"), "run in progress")
+    _write(str(source / "output_append_x1" / "psd.dat"), "append in progress")
+    _write(str(source / "old_run" / "mccode.sim"), "result")
+    _write(str(source / "old_run" / "psd.dat"), "old result")
+
+    stage = ComponentStaging.ComponentStage(str(source / "stage"))
+    manifest = stage.update(str(source), exclude=[str(source / "output")],
+                            generated=GENERATED)
+
+    assert sorted(manifest) == STAGED
+
+
+def test_only_changed_files_are_hashed(source, monkeypatch):
+    stage = ComponentStaging.ComponentStage(str(source / "stage"))
+    stage.update(str(source))
+
+    hashed = []
+    original = ComponentStaging._hash_file
+    monkeypatch.setattr(ComponentStaging, "_hash_file",
+                        lambda path: hashed.append(path) or original(path))
+
+    reloaded = ComponentStaging.ComponentStage(str(source / "stage"))
+    reloaded.update(str(source))
+    assert hashed == []
+
+    _write(str(source / "Union_master.comp"), "changed component")
+    manifest = reloaded.update(str(source))
+    assert hashed == [str(source / "Union_master.comp")]
+    assert manifest["Union_master.comp"] == ComponentStaging._hash_file(
+        str(source / "Union_master.comp"))
+
+
+def test_unreferenced_objects_are_removed(source):
+    stage = ComponentStaging.ComponentStage(str(source / "stage"))
+    view = stage.stage(str(source), generated=GENERATED)
+    assert len(_objects(stage)) == len(STAGED)
+
+    _write(str(source / "Union_master.comp"), "changed component")
+    os.remove(str(source / "notes.txt"))
+    stage.update(str(source), generated=GENERATED)
+
+    assert len(_objects(stage)) == len(STAGED) - 1
+    assert str(source / "notes.txt") not in stage.index
+    # Views made before keep their hardlinks
+    with open(os.path.join(view, "notes.txt")) as file_handle:
+        assert file_handle.read() == "read by a component"
+
+
+def test_release_refuses_other_folders(source):
+    stage = ComponentStaging.ComponentStage(str(source / "stage"))
+    with pytest.raises(ValueError):
+        stage.release(str(source))
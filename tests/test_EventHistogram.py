@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import EventHistogram
+
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(1)
+    return rng.random((20011, 4))
+
+
+def _write_ascii(path, events):
+    with open(path, "w") as file_handle:
+        file_handle.write("# Format: McCode list\n# variables: x y t p\n")
+        np.savetxt(file_handle, events)
+
+
+def _histograms():
+    return [EventHistogram.Histogram("x", 0, 10, (0, 1), weight_column=3),
+            EventHistogram.Histogram("xy", (0, 1), (5, 7), ((0, 1), (0.2, 0.8)),
+                                     weight_column=3),
+            EventHistogram.Histogram("t", 2, 4, (0.25, 0.75))]
+
+
+def _check(result, events):
+    x, y, t, p = events.T
+
+    intensity, edges = np.histogram(x, 10, (0, 1), weights=p)
+    squared, edges = np.histogram(x, 10, (0, 1), weights=p**2)
+    assert np.allclose(result["x"].intensity, intensity)
+    assert np.allclose(result["x"].error, np.sqrt(squared))
+    assert np.allclose(result["x"].edges[0], edges)
+
+    intensity, x_edges, y_edges = np.histogram2d(x, y, (5, 7), ((0, 1), (0.2, 0.8)), weights=p)
+    counts, x_edges, y_edges = np.histogram2d(x, y, (5, 7), ((0, 1), (0.2, 0.8)))
+    assert np.allclose(result["xy"].intensity, intensity)
+    assert np.array_equal(result["xy"].events, counts)
+
+    counts, edges = np.histogram(t, 4, (0.25, 0.75))
+    assert np.allclose(result["t"].intensity, counts)
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_binary_matches_numpy(tmp_path, events, threads):
+    path = str(tmp_path / "events.bin")
+    events.tofile(path)
+
+    reducer = EventHistogram.EventReducer(_histograms(), n_columns=4,
+                                          chunk_size=997, threads=threads)
+    _check(reducer.reduce(path), events)
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_ascii_matches_numpy(tmp_path, events, threads):
+    path = str(tmp_path / "events_list.x.y.t.p")
+    _write_ascii(path, events)
+
+    reducer = EventHistogram.EventReducer(_histograms(), chunk_size=1234, threads=threads)
+    _check(reducer.reduce(path), events)
+
+
+def test_binary_header_is_skipped(tmp_path, events):
+    path = str(tmp_path / "events.bin")
+    with open(path, "wb") as file_handle:
+        file_handle.write(b"12345678")
+        events.astype(np.float32).tofile(file_handle)
+
+    reducer = EventHistogram.EventReducer(_histograms(), n_columns=4, dtype="float32",
+                                          header_bytes=8, chunk_size=5000)
+    _check(reducer.reduce(path), events.astype(np.float32).astype(np.float64))
+
+
+def test_reduce_does_not_change_configured_histograms(tmp_path, events):
+    path = str(tmp_path / "events.bin")
+    events.tofile(path)
+    histograms = _histograms()
+
+    reducer = EventHistogram.EventReducer(histograms, n_columns=4)
+    reducer.reduce(path)
+    reducer.reduce(path)
+
+    assert all(np.all(histogram.intensity == 0) for histogram in histograms)
+
+
+def test_missing_file_raises(tmp_path):
+    reducer = EventHistogram.EventReducer(_histograms(), n_columns=4)
+    with pytest.raises(ValueError):
+        reducer.reduce(str(tmp_path / "missing.bin"))
+
+
+def test_merge_requires_same_binning():
+    with pytest.raises(ValueError):
+        EventHistogram.Histogram("x", 0, 10, (0, 1)).merge(
+            EventHistogram.Histogram("x", 0, 11, (0, 1)))
@@ -0,0 +1,258 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import MonitorAccumulation
+
+CONFIGURATION = {"fingerprint": "abc", "pars": {"energy": 10}}
+
+
+def _write_run(folder, ncount, scale, energy=10, bins=2):
+    os.makedirs(folder)
+    with open(os.path.join(folder, "mccode.sim"), "w") as file_handle:
+        file_handle.write("begin simulation: demo\n"
+                          "  Ncount: %d\n"
+                          "  Param: energy=%g\n"
+                          "end simulation\n\n"
+                          "begin data\n"
+                          "  Ncount: %d\n"
+                          "  filename: e.dat\n"
+                          "  values: 1 1 1\n"
+                          "end data\n\n"
+                          "begin data\n"
+                          "  Ncount: %d\n"
+                          "  filename: psd.dat\n"
+                          "  values: 1 1 1\n"
+                          "end data\n" % (ncount, energy, ncount, ncount))
+
+    rows = "".join("%d %g 0.1 10\n" % (x, scale*x) for x in range(1, bins + 1))
+    with open(os.path.join(folder, "e.dat"), "w") as file_handle:
+        file_handle.write("# Format: McCode\n# type: array_1d(%d)\n# Ncount: %d\n"
+                          "# values: 0 0 0\n# variables: x I I_err N\n%s"
+                          % (bins, ncount, rows))
+
+    with open(os.path.join(folder, "psd.dat"), "w") as file_handle:
+        file_handle.write("# type: array_2d(2, 2)\n# Ncount: %d\n# values: 0 0 0\n"
+                          "# Data [d/psd.dat] I:\n%g %g\n%g %g\n"
+                          "# Errors [d/psd.dat] I_err:\n0.2 0.2\n0.2 0.2\n"
+                          "# Events [d/psd.dat] N:\n1 2\n3 4\n"
+                          % (ncount, scale, 2*scale, 3*scale, 4*scale))
+
+
+def _read_numbers(path):
+    return np.array([[float(value) for value in line.split()]
+                     for line in open(path) if line.strip() and not line.startswith("#")])
+
+
+def test_ascii_fold_matches_hand_sums(tmp_path):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    _write_run(old, 1000, 1.0)
+    _write_run(new, 3000, 2.0)
+
+    assert MonitorAccumulation.fold_results(old, new, 3000) == 4000
+
+    # I = (1000*x + 3000*2x)/4000, E = sqrt(100^2 + 300^2)/4000, N = 10 + 10
+    data = _read_numbers(os.path.join(old, "e.dat"))
+    assert np.allclose(data[:, 1], [1.75, 3.5])
+    assert np.allclose(data[:, 2], np.sqrt(100.0**2 + 300.0**2)/4000)
+    assert np.allclose(data[:, 3], 20)
+
+    psd = _read_numbers(os.path.join(old, "psd.dat"))
+    assert np.allclose(psd[0:2], [[1.75, 3.5], [5.25, 7.0]])
+    assert np.allclose(psd[2:4], np.sqrt(200.0**2 + 600.0**2)/4000)
+    assert np.allclose(psd[4:6], [[2, 4], [6, 8]])
+
+    text = open(os.path.join(old, "e.dat")).read()
+    assert "# Ncount: 4000" in text
+    assert "# values: 5.25 %.10g 40" % (np.sqrt(2)*np.sqrt(100.0**2 + 300.0**2)/4000) in text
+
+    sim = open(os.path.join(old, "mccode.sim")).read()
+    assert "Ncount: 1000" not in sim
+    assert "values: 5.25" in sim and "values: 17.5" in sim
+
+    assert MonitorAccumulation.accumulated_ncount(old) == 4000
+    assert MonitorAccumulation.read_accumulation(old)["runs"] == 2
+
+
+def test_repeated_folds_weight_by_total_ncount(tmp_path):
+    old = str(tmp_path / "old")
+    _write_run(old, 1000, 1.0)
+    for index, scale in enumerate([2.0, 4.0]):
+        new = str(tmp_path / ("new%d" % index))
+        _write_run(new, 1000, scale)
+        MonitorAccumulation.fold_results(old, new, 1000)
+
+    data = _read_numbers(os.path.join(old, "e.dat"))
+    assert np.allclose(data[:, 1], np.array([1, 2])*(1 + 2 + 4)/3)
+    assert MonitorAccumulation.accumulated_ncount(old) == 3000
+
+
+def test_failed_fold_leaves_result_unchanged(tmp_path):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    _write_run(old, 1000, 1.0)
+    _write_run(new, 3000, 2.0)
+    # psd.dat is folded after e.dat, break its binning
+    with open(os.path.join(new, "psd.dat"), "a") as file_handle:
+        file_handle.write("1 1\n")
+
+    before = {name: open(os.path.join(old, name)).read() for name in os.listdir(old)}
+    with pytest.raises(ValueError):
+        MonitorAccumulation.fold_results(old, new, 3000)
+
+    assert {name: open(os.path.join(old, name)).read() for name in os.listdir(old)} == before
+    assert sorted(os.listdir(str(tmp_path))) == ["new", "old", "old.lock"]
+
+
+def test_configuration_mismatch_is_refused(tmp_path):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    _write_run(old, 1000, 1.0)
+    _write_run(new, 3000, 2.0)
+    MonitorAccumulation.write_accumulation(old, 1000, 1, CONFIGURATION)
+
+    MonitorAccumulation.check_configuration(old, {"fingerprint": "abc", "pars": {"energy": 10}})
+    with pytest.raises(ValueError):
+        MonitorAccumulation.fold_results(old, new, 3000,
+                                         {"fingerprint": "abc", "pars": {"energy": 12}})
+    with pytest.raises(ValueError):
+        MonitorAccumulation.fold_results(old, new, 3000,
+                                         {"fingerprint": "other", "pars": {"energy": 10}})
+
+    MonitorAccumulation.fold_results(old, new, 3000, CONFIGURATION)
+    assert MonitorAccumulation.read_accumulation(old)["configuration"] == CONFIGURATION
+
+
+def test_plain_mcstas_result_pars_are_checked(tmp_path):
+    old = str(tmp_path / "old")
+    _write_run(old, 1000, 1.0, energy=10)
+
+    MonitorAccumulation.check_configuration(old, {"fingerprint": "abc", "pars": {"energy": 10.0}})
+    with pytest.raises(ValueError):
+        MonitorAccumulation.check_configuration(old, {"fingerprint": "abc", "pars": {"energy": 5}})
+    with pytest.raises(ValueError):
+        MonitorAccumulation.check_configuration(
+            old, {"fingerprint": "abc", "pars": {"energy": 10, "wavelength": 1}})
+
+
+def test_plain_mcstas_result_defaults_are_accepted(tmp_path):
+    old = str(tmp_path / "old")
+    _write_run(old, 1000, 1.0, energy=10)
+    with open(os.path.join(old, "mccode.sim"), "a") as file_handle:
+        file_handle.write("  Param: radius=0.01\n")
+
+    MonitorAccumulation.check_configuration(old, {"fingerprint": "abc", "pars": {"energy": 10}})
+    MonitorAccumulation.check_configuration(old, {"fingerprint": "abc",
+                                                  "pars": {"energy": 10, "radius": 0.01}})
+    with pytest.raises(ValueError):
+        MonitorAccumulation.check_configuration(old, {"fingerprint": "abc",
+                                                      "pars": {"energy": 10, "radius": 0.02}})
+
+
+def test_simultaneous_folds_keep_all_rays(tmp_path):
+    old = str(tmp_path / "old")
+    _write_run(old, 1000, 1.0)
+    new_folders = []
+    for index in range(4):
+        new = str(tmp_path / ("new%d" % index))
+        _write_run(new, 1000, 1.0)
+        new_folders.append(new)
+
+    threads = [threading.Thread(target=MonitorAccumulation.fold_results, args=(old, new, 1000))
+               for new in new_folders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert MonitorAccumulation.accumulated_ncount(old) == 5000
+    assert MonitorAccumulation.read_accumulation(old)["runs"] == 5
+    assert np.allclose(_read_numbers(os.path.join(old, "e.dat"))[:, 3], 50)
+
+
+class _Instrument:
+    """ Stands in for McStas_instr, writing its instrument file like McStasScript """
+
+    def __init__(self, radius):
+        self.name = "demo"
+        self.input_path = "."
+        self.radius = radius
+        self.writes = 0
+
+    def write_full_instrument(self):
+        self.writes += 1
+        with open(os.path.join(self.input_path, self.name + ".instr"), "w") as file_handle:
+            file_handle.write("* Instrument: demo\n* Date: write %d\n"
+                              "COMPONENT sample = Union_cylinder(radius=%g)\n"
+                              % (self.writes, self.radius))
+
+
+def test_instrument_hash_covers_component_parameters(tmp_path):
+    instrument = _Instrument(0.01)
+    instrument.input_path = str(tmp_path)
+
+    first = MonitorAccumulation.instrument_hash(instrument)
+    assert MonitorAccumulation.instrument_hash(instrument) == first
+    assert instrument.input_path == str(tmp_path)
+    assert os.listdir(str(tmp_path)) == []
+
+    instrument.radius = 0.02
+    assert MonitorAccumulation.instrument_hash(instrument) != first
+
+
+def test_event_lists_are_not_folded(tmp_path):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    _write_run(old, 1000, 1.0)
+    _write_run(new, 3000, 2.0)
+    with open(os.path.join(old, "list.dat"), "w") as file_handle:
+        file_handle.write("# type: array_2d(3, 2)\n1 2 3\n4 5 6\n")
+    with open(os.path.join(new, "list.dat"), "w") as file_handle:
+        file_handle.write("# type: array_2d(3, 3)\n1 2 3\n4 5 6\n7 8 9\n")
+
+    MonitorAccumulation.fold_results(old, new, 3000)
+    assert open(os.path.join(old, "list.dat")).read() == "# type: array_2d(3, 2)\n1 2 3\n4 5 6\n"
+    assert MonitorAccumulation.accumulated_ncount(old) == 4000
+
+
+def _write_h5(path, ncount, scale):
+    h5py = pytest.importorskip("h5py")
+    with h5py.File(path, "w") as h5:
+        h5.create_group("entry1/simulation/Param").attrs["energy"] = b"10"
+        monitor = h5.create_group("entry1/data/psd_dat")
+        monitor.attrs["Ncount"] = str(ncount).encode()
+        monitor.create_dataset("data", data=scale*np.array([[1.0, 2.0], [3.0, 4.0]]))
+        monitor.create_dataset("errors", data=np.full((2, 2), 0.2))
+        monitor.create_dataset("ncount", data=np.array([[1, 2], [3, 4]]))
+
+
+def test_hdf5_fold(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    old, new = tmp_path / "old", tmp_path / "new"
+    old.mkdir()
+    new.mkdir()
+    _write_h5(str(old / "mccode.h5"), 1000, 1.0)
+    _write_h5(str(new / "mccode.h5"), 3000, 2.0)
+
+    assert MonitorAccumulation.accumulated_ncount(str(old)) == 1000
+    MonitorAccumulation.check_configuration(str(old), {"fingerprint": "abc", "pars": {"energy": 10}})
+    with pytest.raises(ValueError):
+        MonitorAccumulation.check_configuration(str(old), {"fingerprint": "abc",
+                                                           "pars": {"energy": 11}})
+
+    MonitorAccumulation.fold_results(str(old), str(new), 3000)
+
+    with h5py.File(str(old / "mccode.h5"), "r") as h5:
+        monitor = h5["entry1/data/psd_dat"]
+        assert np.allclose(monitor["data"][()], [[1.75, 3.5], [5.25, 7.0]])
+        assert np.allclose(monitor["errors"][()], np.sqrt(200.0**2 + 600.0**2)/4000)
+        assert np.array_equal(monitor["ncount"][()], [[2, 4], [6, 8]])
+        assert float(monitor.attrs["Ncount"]) == 4000
+        assert h5.attrs["Ncount"] == 4000
+
+    with h5py.File(str(new / "mccode.h5"), "r") as h5:
+        assert np.allclose(h5["entry1/data/psd_dat/data"][()], [[2, 4], [6, 8]])
+
+
+def test_missing_ncount_raises(tmp_path):
+    with pytest.raises(ValueError):
+        MonitorAccumulation.accumulated_ncount(str(tmp_path))
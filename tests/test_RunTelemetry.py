@@ -0,0 +1,149 @@
+import json
+import types
+
+import numpy as np
+import pytest
+
+import RunTelemetry
+
+
+def _wall_time(mpi, ncount, startup=5.0, per_rank=1.0, rays_per_second=1E6):
+    return startup + per_rank*mpi + ncount/(rays_per_second*mpi)
+
+
+def _auto_runs(telemetry, ncount, runs, noise=0.0, seed=0):
+    """ Runs as the calculator does with mpi="auto" """
+    rng = np.random.default_rng(seed)
+    for _ in range(runs):
+        mpi = telemetry.predict("instr", ncount)["mpi"]
+        wall_time = _wall_time(mpi, ncount)*(1 + noise*rng.standard_normal())
+        telemetry.record("instr", mpi, ncount, wall_time)
+
+
+def test_no_prediction_without_runs(tmp_path):
+    telemetry = RunTelemetry.RunTelemetry(str(tmp_path / "telemetry.jsonl"), max_mpi=16)
+
+    assert telemetry.predict("instr", 1E5) == {"mpi": 16, "wall_time": None,
+                                               "core_seconds": None}
+
+
+def test_single_run_is_not_identifiable(tmp_path):
+    telemetry = RunTelemetry.RunTelemetry(str(tmp_path / "telemetry.jsonl"), max_mpi=16)
+    telemetry.record("instr", 16, 1E5, _wall_time(16, 1E5))
+
+    prediction = telemetry.predict("instr", 1E5)
+    assert prediction["wall_time"] is None
+    assert prediction["mpi"] == 1
+    assert telemetry.predict("instr", 1E5, mpi=16)["wall_time"] is None
+
+
+def test_auto_runs_explore_until_fit(tmp_path):
+    telemetry = RunTelemetry.RunTelemetry(str(tmp_path / "telemetry.jsonl"), max_mpi=16)
+    _auto_runs(telemetry, 1E5, 3)
+
+    assert sorted({run["mpi"] for run in telemetry.runs("instr")}) == [1, 8, 16]
+
+    model = telemetry.model("instr")
+    assert model["startup"] == pytest.approx(5.0)
+    assert model["startup_per_rank"] == pytest.approx(1.0)
+    assert model["rays_per_second_per_rank"] == pytest.approx(1E6)
+
+    prediction = telemetry.predict("instr", 1E5)
+    assert prediction["mpi"] == 1
+    assert prediction["wall_time"] == pytest.approx(_wall_time(1, 1E5))
+
+    prediction = telemetry.predict("instr", 1E9)
+    assert prediction["mpi"] == 16
+    assert prediction["wall_time"] == pytest.approx(_wall_time(16, 1E9))
+
+
+@pytest.mark.parametrize("max_mpi", [2, 3])
+def test_few_cores_reach_an_estimate(tmp_path, max_mpi):
+    telemetry = RunTelemetry.RunTelemetry(str(tmp_path / "telemetry.jsonl"), max_mpi=max_mpi)
+    _auto_runs(telemetry, 1E7, 3)
+
+    prediction = telemetry.predict("instr", 1E7)
+    assert prediction["wall_time"] is not None
+    assert prediction["wall_time"] == pytest.approx(_wall_time(prediction["mpi"], 1E7), rel=0.2)
+
+
+def test_predict_reads_log_once(tmp_path, monkeypatch):
+    telemetry = RunTelemetry.RunTelemetry(str(tmp_path / "telemetry.jsonl"), max_mpi=16)
+    telemetry.record("instr", 16, 1E5, _wall_time(16, 1E5))
+
+    reads = []
+    original = telemetry._read_runs
+    monkeypatch.setattr(telemetry, "_read_runs", lambda: reads.append(1) or original())
+    telemetry.predict("instr", 1E5)
+
+    assert len(reads) == 1
+
+
+def test_log_is_compacted(tmp_path):
+    path = tmp_path / "telemetry.jsonl"
+    telemetry = RunTelemetry.RunTelemetry(str(path))
+    telemetry.max_records = 5
+    telemetry.compact_bytes = 2000
+    for index in range(40):
+        telemetry.record("instr", 1 + index, 1E6, 1.0)
+        telemetry.record("other", 1, 1E6, 1.0)
+
+    assert path.stat().st_size <= 2000 + 200
+    assert [run["mpi"] for run in telemetry.runs("instr")] == [36, 37, 38, 39, 40]
+    assert len(telemetry.runs("other")) == 5
+
+
+def test_fit_with_noise(tmp_path):
+    telemetry = RunTelemetry.RunTelemetry(str(tmp_path / "telemetry.jsonl"), max_mpi=64)
+    rng = np.random.default_rng(3)
+    for mpi, ncount in zip(rng.integers(1, 65, 30), 10**rng.uniform(6, 9, 30)):
+        telemetry.record("instr", int(mpi), ncount,
+                         _wall_time(mpi, ncount)*(1 + 0.03*rng.standard_normal()))
+
+    model = telemetry.model("instr")
+    assert model is not None
+    assert model["startup"] >= 0 and model["startup_per_rank"] >= 0
+    assert model["rays_per_second_per_rank"] == pytest.approx(1E6, rel=0.1)
+
+    prediction = telemetry.predict("instr", 1E8)
+    assert prediction["wall_time"] == pytest.approx(_wall_time(prediction["mpi"], 1E8), rel=0.1)
+
+
+def test_records_are_appended(tmp_path):
+    path = tmp_path / "telemetry.jsonl"
+    first = RunTelemetry.RunTelemetry(str(path))
+    second = RunTelemetry.RunTelemetry(str(path))
+
+    first.record("instr", 1, 1E6, 2.0)
+    second.record("instr", 2, 1E6, 1.5)
+    second.record("other", 2, 1E6, 1.5)
+    with open(str(path), "a") as file_handle:
+        file_handle.write('{"fingerprint": "instr", "mp')
+
+    assert [run["mpi"] for run in first.runs("instr")] == [1, 2]
+    assert len(path.read_text().splitlines()) == 4
+    assert json.loads(path.read_text().splitlines()[0])["wall_time"] == 2.0
+
+
+def _instrument(name, components):
+    parameter = types.SimpleNamespace(name="energy")
+    return types.SimpleNamespace(
+        name=name, parameter_list=[parameter],
+        component_list=[types.SimpleNamespace(name=component_name, component_name=component_type)
+                        for component_name, component_type in components])
+
+
+def test_fingerprint_follows_layout():
+    source = ("Source", "Source_simple")
+    monitor = ("Detector", "PSD_monitor")
+
+    fingerprint = RunTelemetry.instrument_fingerprint(_instrument("demo", [source, monitor]))
+    assert fingerprint == RunTelemetry.instrument_fingerprint(_instrument("demo", [source, monitor]))
+    assert fingerprint != RunTelemetry.instrument_fingerprint(_instrument("demo", [source]))
+    assert fingerprint != RunTelemetry.instrument_fingerprint(
+        _instrument("demo", [source, ("Detector", "E_monitor")]))
+
+
+def test_fingerprint_needs_instrument_lists():
+    with pytest.raises(AttributeError):
+        RunTelemetry.instrument_fingerprint(types.SimpleNamespace(name="demo"))